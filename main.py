@@ -1,143 +1,342 @@
-import requests
-import xml.etree.ElementTree as ET
-import pandas as pd
+import httpx
 import sys
+import asyncio
+import concurrent.futures
+import csv
+import gzip
+import hashlib
+import os
+import threading
+import time
 from lxml import etree
-from requests_html import HTMLSession
+from playwright.async_api import Error as PlaywrightError, async_playwright
 from tqdm import tqdm
-import time
+from urllib.parse import urlsplit
 
-# Track failed and no-iframe URLs
+# Track failed, no-iframe and filtered-out URLs
 failed_urls = []
 no_iframe_urls = []
-results = []  # Store extracted iframes
+skipped_urls = []
+renders_skipped = 0  # Pages where the iframe was already in the static HTML
+cache_hits = 0  # Pages served from the on-disk render cache
 
-# Initialize a global session
-session = None
+# Sitemap entries that can never host the contact iframe
+SKIP_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".xml")
+SKIP_PATH_FRAGMENTS = ("/wp-content/",)
 
-def create_session():
-    """Creates a new HTML session and returns it."""
-    global session
-    if session is not None:
-        try:
-            session.close()  # Close existing session safely
-        except:
-            pass
-    session = HTMLSession()
-    return session
+# Marker whose absence proves a page has no contact iframe; its presence
+# is only a hint (noscript fallbacks, comments and inline JS match too)
+MARKER = "contact.sigma-rh.com"
+MARKER_BYTES = MARKER.encode()
+
+CHUNK_SIZE = 65536  # Bytes per streamed read
+FETCH_TIMEOUT = 20
+
+RESULT_FIELDS = ["page_url", "src_url", "iframe_html"]
+FLUSH_EVERY = 50  # Rows between CSV flushes
+
+# Resources that can't affect iframe presence; not worth the bandwidth
+BLOCKED_ASSETS = "**/*.{png,jpg,jpeg,gif,svg,ico,woff,woff2,ttf,css}"
+RENDER_TIMEOUT_MS = 30000
+
+# On-disk cache of rendered pages, so reruns skip network + Chromium
+CACHE_DIR = ".cache"
+CACHE_TTL = 24 * 3600  # Seconds before a cached page goes stale
+
+# Append-only log of completed URLs; lets an interrupted run resume
+DONE_LOG = "done.txt"
+
+# lxml releases the GIL while parsing, but serializes concurrent use of a
+# single parser instance on an internal lock — so each pool thread gets its
+# own tuned parser and the pool actually parses pages in parallel
+_PARSE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+_PARSER_LOCAL = threading.local()
+
+def _get_parser():
+    """Returns this thread's HTML parser, building it on first use."""
+    parser = getattr(_PARSER_LOCAL, "parser", None)
+    if parser is None:
+        # Skips comments/PIs and the element-ID table we never use
+        parser = etree.HTMLParser(recover=True, remove_comments=True, remove_pis=True, collect_ids=False)
+        _PARSER_LOCAL.parser = parser
+    return parser
 
 def log_error(message):
     """Print errors to stderr for real-time visibility."""
     print(f"❌ {message}", file=sys.stderr)
 
-def extract_contact_iframe(url, retries=3):
-    """Extracts iframes while ignoring noscript, with retries only for actual errors."""
-    global session
+def _cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".html.gz")
 
-    for attempt in range(retries):
-        try:
-            if session is None:
-                session = create_session()
+def _cache_get(url):
+    """Returns the cached HTML for a URL, or None if missing or stale."""
+    path = _cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(path) < CACHE_TTL:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                return f.read()
+    except OSError:
+        pass
+    return None
+
+def _cache_put(url, html):
+    """Stores rendered HTML for a URL in the on-disk cache."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with gzip.open(_cache_path(url), "wt", encoding="utf-8") as f:
+        f.write(html)
+
+async def _fetch_static(client, url):
+    """Streams the page body, stopping the download early once the marker appears."""
+    async with client.stream("GET", url) as response:
+        if response.status_code == 429 or response.status_code >= 500:
+            return response.status_code, None
+
+        chunks = []
+        tail = b""
+        found = False
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            chunks.append(chunk)
+            if found:
+                break  # One extra chunk buffered so the full iframe tag is present
+            if MARKER_BYTES in tail + chunk:
+                found = True
+            tail = chunk[-len(MARKER_BYTES):]
+
+        body = b"".join(chunks)
+        return response.status_code, body.decode(response.encoding or "utf-8", errors="replace")
+
+def _extract_iframes(html, url):
+    """Parses HTML and returns the contact.sigma-rh.com iframes, ignoring noscript."""
+    tree = etree.fromstring(html, _get_parser())
+    if tree is None:  # recover=True yields None for empty input
+        return []
+
+    # Remove all <noscript> elements before searching for iframes
+    for noscript in list(tree.iter("noscript")):
+        noscript.getparent().remove(noscript)
 
-            r = session.get(url)
+    # Return on the first valid iframe: one contact iframe is enough per
+    # page, and call sites expect a (possibly empty) list of rows
+    for iframe in tree.iter("iframe"):
+        src = iframe.get("src")
+        if src and MARKER in src:
+            return [{
+                "page_url": url,  # Page where iframe was found
+                "src_url": src,   # Contact Sigma-RH iframe URL
+                "iframe_html": etree.tostring(iframe, encoding="unicode")  # Full iframe tag
+            }]
+    return []
 
-            # Render JavaScript with timeout (reduce from 10s to 6s to prevent hanging)
-            r.html.render(timeout=6, sleep=2)
+async def _parse_if_marked(html, url):
+    """Runs _extract_iframes off the event loop, skipping pages the marker rules out."""
+    if MARKER not in html:
+        return []
+    return await asyncio.get_running_loop().run_in_executor(_PARSE_POOL, _extract_iframes, html, url)
+
+async def extract_contact_iframe(client, context, url, retries=3):
+    """Extracts iframes while ignoring noscript, with retries only for actual errors."""
+    global renders_skipped, cache_hits
 
-            # Parse HTML using lxml
-            tree = etree.HTML(r.html.html)
+    for attempt in range(retries):
+        try:
+            html = _cache_get(url)
+            if html is not None:
+                # Fresh copy on disk: no network, no render
+                cache_hits += 1
+                extracted_iframes = await _parse_if_marked(html, url)
+            else:
+                status, html = await _fetch_static(client, url)
 
-            # Remove all <noscript> elements before searching for iframes
-            for noscript in tree.xpath('//noscript'):
-                noscript.getparent().remove(noscript)
+                # Back off only when the server actually pushes back
+                if status == 429 or status >= 500:
+                    log_error(f"⚠️ Got HTTP {status} from {url}, backing off...")
+                    if attempt == retries - 1:
+                        log_error(f"❌ Skipping {url} after {retries} throttled attempts (HTTP {status}).")
+                        failed_urls.append({"page_url": url})
+                        return None
+                    await asyncio.sleep(2 ** attempt)
+                    continue
 
-            # Extract valid iframes
-            iframes = tree.xpath("//iframe[@src]")
-            extracted_iframes = []
-            for iframe in iframes:
-                src = iframe.get("src")
-                if "contact.sigma-rh.com" in src:
-                    extracted_iframes.append({
-                        "page_url": url,  # Page where iframe was found
-                        "src_url": src,   # Contact Sigma-RH iframe URL
-                        "iframe_html": etree.tostring(iframe, encoding="unicode")  # Full iframe tag
-                    })
+                # Check the static HTML first: when the iframe is server-side
+                # rendered (the common case), rendering the page is pure waste.
+                # Only an actually extracted iframe proves it's SSR'd — a bare
+                # marker hit may sit in a noscript block or the JS that injects
+                # the iframe, so anything less falls through to the render.
+                extracted_iframes = await _parse_if_marked(html, url)
+                if extracted_iframes:
+                    renders_skipped += 1
+                else:
+                    # Render JavaScript in a tab of the shared browser
+                    page = await context.new_page()
+                    try:
+                        await page.goto(url, wait_until="domcontentloaded", timeout=RENDER_TIMEOUT_MS)
+                        html = await page.content()
+                    finally:
+                        await page.close()
+                    _cache_put(url, html)
+                    extracted_iframes = await _parse_if_marked(html, url)
 
             if extracted_iframes:
                 print(f"✅ Successfully extracted iframe from {url} on attempt {attempt+1}/{retries}")
                 return extracted_iframes
-            
-            # If no iframe found, log the URL
+
+            # If no iframe found, log the URL; the empty list still marks
+            # the URL as completed, unlike the None returned on failure
             print(f"⚠️ No iframe found on {url}. Logging it for review.")
             no_iframe_urls.append({"page_url": url})
-            return None
+            return []
 
-        except requests.exceptions.RequestException as e:
+        except (PlaywrightError, httpx.HTTPError) as e:
             log_error(f"⚠️ Attempt {attempt+1}/{retries} failed for {url}: {e}")
-            time.sleep(3)  # Sleep before retrying
+
+            if attempt == retries - 1:
+                log_error(f"❌ Skipping {url} after {retries} failed attempts (due to errors).")
+                failed_urls.append({"page_url": url})
+            else:
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff before retrying
 
         except Exception as e:
             log_error(f"⚠️ Attempt {attempt+1}/{retries} failed for {url}: {e}")
 
-            # If the session is closed, restart it
-            if "Session is closed" in str(e) or "RuntimeError" in str(e):
-                log_error("🔄 Session closed unexpectedly, creating a new one...")
-                session = create_session()
-                time.sleep(2)  # Small delay to prevent rapid re-creation
-
-            elif attempt == retries - 1:
+            if attempt == retries - 1:
                 log_error(f"❌ Skipping {url} after {retries} failed attempts (due to errors).")
                 failed_urls.append({"page_url": url})
     return None
 
-def get_urls_from_sitemap(sitemap_url):
-    """Extracts all URLs from the sitemap."""
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+async def get_urls_from_sitemap(client, sitemap_url):
+    """Streams URLs out of the sitemap as the download arrives."""
     try:
-        response = requests.get(sitemap_url, timeout=10)
-        response.raise_for_status()  # Raise an error for bad responses
-        root = ET.fromstring(response.content)
-        ns = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        return [loc.text for loc in root.findall(".//ns:loc", ns)]
+        parser = etree.XMLPullParser(tag=f"{{{SITEMAP_NS}}}loc")
+        async with client.stream("GET", sitemap_url, timeout=10) as response:
+            response.raise_for_status()  # Raise an error for bad responses
+            async for chunk in response.aiter_bytes():
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    yield elem.text
+                    # Keep memory flat regardless of sitemap size
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
     except Exception as e:
         log_error(f"❌ Error fetching sitemap: {e}")
-        return []
 
-def run_sequentially(urls):
-    """Runs all URLs sequentially to avoid crashes."""
-    global session
-    session = create_session()  # Initialize session once at the beginning
+def _append_url_log(path, rows):
+    """Appends new page_urls to a single-column CSV, writing the header once.
+
+    Appending (rather than rewriting) keeps records from earlier runs, which
+    resumed runs skip via the done-log and so never re-produce in memory.
+    """
+    try:
+        with open(path, newline="") as f:
+            existing = {row[0] for row in csv.reader(f)}
+    except FileNotFoundError:
+        existing = set()
+
+    with open(path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(["page_url"])
+        writer.writerows((row["page_url"],) for row in rows if row["page_url"] not in existing)
+
+def filter_urls(urls):
+    """Drops URLs that can't host the iframe, keeping them for audit."""
+    for url in urls:
+        lowered = url.lower()
+        if lowered.endswith(SKIP_EXTENSIONS) or any(frag in lowered for frag in SKIP_PATH_FRAGMENTS):
+            skipped_urls.append({"page_url": url})
+        else:
+            yield url
+
+async def scrape_all(client, urls, concurrency=8):
+    """Runs all URLs through a bounded pool of concurrent workers."""
+    sem = asyncio.Semaphore(concurrency)
 
-    for url in tqdm(urls, desc="Scraping Progress"):
-        result = extract_contact_iframe(url)
-        if result is not None:
-            results.extend(result)  # Store iframe results
+    async with async_playwright() as p:
+        # One Chromium shared by all workers; each render gets its own tab
+        browser = await p.chromium.launch()
+        context = await browser.new_context()
+        await context.route(BLOCKED_ASSETS, lambda route: route.abort())
 
-    session.close()  # Close session after scraping
+        async def _one(url):
+            async with sem:
+                return url, await extract_contact_iframe(client, context, url)
 
-def main():
-    # Get the list of URLs from the sitemap
-    sitemap_url = "https://www.sigma-rh.com/sitemap.xml"
-    urls = get_urls_from_sitemap(sitemap_url)
+        tasks = [asyncio.create_task(_one(url)) for url in urls]
+        print(f"🚀 Processing {len(tasks)} URLs with up to {concurrency} renders in flight...")
 
-    print(f"🚀 Running in sequential mode with a persistent session. Processing {len(urls)} URLs...")
+        # Stream iframe rows to disk as they complete instead of
+        # accumulating them in memory for the whole run; the CSV is
+        # appended so resumed runs keep earlier results
+        iframes_found = 0
+        with open("sigma_iframes.csv", "a", newline="") as csvfile, \
+                open(DONE_LOG, "a", buffering=1) as done_fp:
+            writer = csv.DictWriter(csvfile, fieldnames=RESULT_FIELDS)
+            if csvfile.tell() == 0:
+                writer.writeheader()
+            with tqdm(total=len(tasks), desc="Scraping Progress") as pbar:
+                for task in asyncio.as_completed(tasks):
+                    url, result = await task
+                    if result is not None:
+                        done_fp.write(url + "\n")  # Completed; skip on resume
+                    if result:
+                        writer.writerows(result)
+                        iframes_found += len(result)
+                        if iframes_found % FLUSH_EVERY == 0:
+                            csvfile.flush()  # Keep results crash-safe
+                    pbar.update(1)
 
-    # Process URLs sequentially
-    run_sequentially(urls)
+        await browser.close()  # Close browser after scraping
+    return iframes_found
+
+async def main():
+    # One HTTP/2 client shared by the sitemap fetch and the static fast
+    # path: same-origin requests multiplex over one connection
+    client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(FETCH_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        follow_redirects=True,
+    )
+    try:
+        # Stream URLs from the sitemap, dropping ones that can't host the iframe
+        sitemap_url = "https://www.sigma-rh.com/sitemap.xml"
+        urls = filter_urls([url async for url in get_urls_from_sitemap(client, sitemap_url)])
+
+        # Dedup (nested sitemap indexes repeat URLs) and cluster by host so
+        # consecutive requests reuse warm keep-alive connections
+        urls = sorted(dict.fromkeys(urls), key=lambda u: urlsplit(u).netloc)
+
+        # Skip URLs a previous (interrupted) run already completed
+        try:
+            with open(DONE_LOG) as f:
+                done = {line.strip() for line in f}
+        except FileNotFoundError:
+            done = set()
+        if done:
+            urls = [url for url in urls if url not in done]
+            print(f"🔁 Resuming: {len(done)} URLs already completed in a previous run.")
 
-    # Convert results to a DataFrame
-    df_iframes = pd.DataFrame(results, columns=["page_url", "src_url", "iframe_html"])
-    df_failed = pd.DataFrame(failed_urls, columns=["page_url"])
-    df_no_iframe = pd.DataFrame(no_iframe_urls, columns=["page_url"])
+        # Process URLs concurrently with bounded parallelism;
+        # iframe rows are streamed to sigma_iframes.csv as they complete
+        iframes_found = await scrape_all(client, urls)
+    finally:
+        await client.aclose()
 
-    # Save everything to CSV at the end
-    df_iframes.to_csv("sigma_iframes.csv", index=False)
-    df_failed.to_csv("failed_urls.csv", index=False)
-    df_no_iframe.to_csv("no_iframes.csv", index=False)
+    # Save the URL logs to CSV at the end; appended so they stay in sync
+    # with the done-log and results CSV across resumed runs
+    _append_url_log("failed_urls.csv", failed_urls)
+    _append_url_log("no_iframes.csv", no_iframe_urls)
+    _append_url_log("skipped_urls.csv", skipped_urls)
 
-    print(f"✅ Processing complete. {len(df_iframes)} valid iframes found.")
-    print(f"⚠️ {len(df_no_iframe)} URLs had no iframes (saved to no_iframes.csv).")
-    print(f"⚠️ {len(df_failed)} URLs failed due to errors (saved to failed_urls.csv).")
+    print(f"✅ Processing complete. {iframes_found} valid iframes found.")
+    print(f"⚡ {renders_skipped} URLs served the iframe in static HTML (render skipped).")
+    print(f"💾 {cache_hits} URLs served from the render cache.")
+    print(f"⚠️ {len(no_iframe_urls)} URLs had no iframes (saved to no_iframes.csv).")
+    print(f"⚠️ {len(failed_urls)} URLs failed due to errors (saved to failed_urls.csv).")
+    print(f"⏭️ {len(skipped_urls)} URLs filtered out before fetching (saved to skipped_urls.csv).")
 
 # Run the script
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())